@@ -1,20 +1,43 @@
 import argparse
+import concurrent.futures
 import dataclasses
 import enum
 import functools
-import json
+import heapq
+import itertools
+import os
+import re
 import sys
-import urllib
+import time
 from pathlib import Path
 from packaging.version import Version, InvalidVersion
 import typing as t
 
+import orjson
+import urllib3
 from wheel_filename import parse_wheel_filename, InvalidFilenameError, ParsedWheelFilename
 
-Comparator: t.TypeAlias = t.Literal[">="] | t.Literal["=="]
-ComparableVersion: t.TypeAlias = t.Tuple[Comparator, Version]
-
 PYPI_URL = "https://pypi.org/pypi/{name}/json"
+PYTHON_CLASSIFIER_RE = re.compile(r"Programming Language :: Python :: (\d+(?:\.\d+)*)")
+FETCH_WORKERS = 32
+
+# A shared pool keeps connections to PyPI alive across requests instead of doing
+# a new TLS handshake for every project
+HTTP = urllib3.PoolManager(
+    maxsize=FETCH_WORKERS,
+    headers={"Accept": "application/json", "Accept-Encoding": "gzip", "User-Agent": "pyreadiness-spike"},
+    # Back off and retry when PyPI is throttling us or having a bad moment
+    retries=urllib3.Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]),
+)
+PROJECT_META_CACHE = "top-metas/{0}.json"
+# PyPI metadata changes with every release, so don't hold on to it for too long
+PROJECT_META_MAX_AGE = 7 * 24 * 60 * 60
+# Python versions whose readiness statuses get stored alongside the cached wheels
+PRECOMPUTED_PYTHON_VERSIONS = [Version(f"3.{minor}") for minor in range(8, 15)]
+
+# Cheap check for the common shapes of pre-release version strings, so that most
+# of them can be skipped without a full Version parse
+PRE_RELEASE_RE = re.compile(r"v?(?:\d+!)?\d+(?:\.\d+)*[-_.]?(?:a|b|c|rc|alpha|beta|pre|preview|dev)", re.IGNORECASE)
 
 # BigQuery query for listing top projects
 TOP_PROJECTS_QUERY = """
@@ -35,15 +58,29 @@ LIMIT
   360
 """
 
-def cache_json(filename: str):
+def is_cache_fresh(saved: Path, max_age: t.Optional[float]) -> bool:
+    if not saved.is_file():
+        return False
+    return max_age is None or time.time() - saved.stat().st_mtime < max_age
+
+
+def cache_json(filename: str, max_age: t.Optional[float] = None):
+    # filename may contain str.format placeholders that get filled in with the
+    # fetcher's arguments, so that each set of arguments is cached separately.
+    # Caches older than max_age seconds, when given, get fetched again.
     def decorator(fetcher):
         @functools.wraps(fetcher)
         def wrapper(*args, **kwargs):
-            saved = Path(filename)
-            if saved.is_file():
-                return json.loads(saved.read_text())
+            saved = Path(filename.format(*args, **kwargs))
+            if is_cache_fresh(saved, max_age):
+                return orjson.loads(saved.read_bytes())
             data = fetcher(*args, **kwargs)
-            saved.write_text(json.dumps(data, indent=2))
+            saved.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first so that an interrupted or concurrent run
+            # never leaves a truncated cache behind
+            tmp = saved.with_name(f"{saved.name}.{os.getpid()}.tmp")
+            tmp.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+            os.replace(tmp, saved)
             return data
         return wrapper
     return decorator
@@ -83,17 +120,49 @@ def load_top_projects():
 
 def fetch_project_meta(name):
     print(f"Fetching '{name}'", file=sys.stderr)
-    response = urllib.request.urlopen(PYPI_URL.format(name=name))
-    return json.loads(response.read())
-
-
-@cache_json("top-metas.json")
-def load_top_metas():
-    projects = load_top_projects()
-    metas = {}
-    for project in projects:
-        metas[project["project"]] = fetch_project_meta(project["project"])
-    return metas
+    response = HTTP.request("GET", PYPI_URL.format(name=name))
+    if response.status != 200:
+        raise urllib3.exceptions.HTTPError(f"Fetching '{name}' failed with status {response.status}")
+    return orjson.loads(response.data)
+
+
+def trim_project_meta(project_meta) -> dict:
+    # The full metadata has descriptions, digests, URLs and so on for every file;
+    # keep just what list_available_versions looks at, so the cache stays small
+    return dict(
+        info=dict(name=project_meta["info"]["name"], classifiers=project_meta["info"]["classifiers"]),
+        releases={
+            version_string: [
+                dict(filename=file_meta["filename"], packagetype=file_meta["packagetype"], yanked=file_meta["yanked"])
+                for file_meta in files
+            ]
+            for version_string, files in project_meta["releases"].items()
+        },
+    )
+
+
+@cache_json(PROJECT_META_CACHE, max_age=PROJECT_META_MAX_AGE)
+def load_project_meta(name):
+    return trim_project_meta(fetch_project_meta(name))
+
+
+def fetch_top_metas() -> t.List[str]:
+    names = [project["project"] for project in load_top_projects()]
+    missing = [name for name in names if not is_cache_fresh(Path(PROJECT_META_CACHE.format(name)), PROJECT_META_MAX_AGE)]
+    # Fetching is network-bound, so threads are enough to overlap the requests.
+    # Results only get written to disk here; each project is read back on its own
+    # later so that we never hold every project's metadata in memory at once.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        for _ in executor.map(load_project_meta, missing):
+            pass
+    return names
+
+
+@functools.lru_cache(maxsize=None)
+def parse_version(version_string: str) -> Version:
+    # The same handful of version strings (wheel python tags in particular) get
+    # parsed over and over across projects, and Version() isn't cheap.
+    return Version(version_string)
 
 
 def list_unyanked_wheels(project_meta_files) -> t.Iterator[ParsedWheelFilename]:
@@ -108,14 +177,30 @@ def list_unyanked_wheels(project_meta_files) -> t.Iterator[ParsedWheelFilename]:
             print("warn: skpping wheel with invalid filename:", file_meta["filename"], file=sys.stderr)
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Wheel:
     name: str
-    python_tags: t.Set[str]
-    abi_tags: t.Set[str]
+    # Wheels rarely have more than a couple of tags, so tuples are plenty
+    python_tags: t.Tuple[str, ...]
+    abi_tags: t.Tuple[str, ...]
+    # abi3 signals that the package adheres to a minimum set of instructions and
+    # is forward-compatible
+    has_abi3: bool = dataclasses.field(init=False)
+
+    def __post_init__(self):
+        self.has_abi3 = "abi3" in self.abi_tags
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Wheel":
+        return cls(name=data["name"], python_tags=tuple(data["python_tags"]), abi_tags=tuple(data["abi_tags"]))
+
+    def to_dict(self) -> dict:
+        # Much cheaper than dataclasses.asdict, which deep-copies every field
+        # (orjson writes tuples out as arrays, so there's no need to copy them into lists)
+        return {"name": self.name, "python_tags": self.python_tags, "abi_tags": self.abi_tags}
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class PackageVersion:
     version: Version
     wheels: t.List[Wheel] = dataclasses.field(default_factory=list)
@@ -126,8 +211,10 @@ class PackageVersion:
 
 def list_available_versions(project_meta) -> t.Iterator[PackageVersion]:
     for version_string, files in project_meta["releases"].items():
+        if PRE_RELEASE_RE.match(version_string):
+            continue
         try:
-            version = Version(version_string)
+            version = parse_version(version_string)
         except InvalidVersion:
             print("warn: skpping version with invalid format", project_meta["info"]["name"], version_string, file=sys.stderr)
             continue
@@ -135,121 +222,210 @@ def list_available_versions(project_meta) -> t.Iterator[PackageVersion]:
             continue
         wheels = []
         for wheel_name in list_unyanked_wheels(files):
-            wheels.append(Wheel(name=str(wheel_name), python_tags=wheel_name.python_tags, abi_tags=wheel_name.abi_tags))
+            wheels.append(Wheel(name=str(wheel_name), python_tags=tuple(wheel_name.python_tags), abi_tags=tuple(wheel_name.abi_tags)))
         if wheels:
-            yield PackageVersion(version=Version(version_string), wheels=wheels)
+            yield PackageVersion(version=version, wheels=wheels)
+
+
+def summarize_project(name) -> dict:
+    project_meta = load_project_meta(name)
+    python_classifier_versions = list_python_classifier_versions(project_meta["info"]["classifiers"])
+    releases = {
+        str(package_version.version): [wheel.to_dict() for wheel in package_version.wheels]
+        for package_version in list_available_versions(project_meta)
+    }
+    # The statuses only depend on the cached data and the Python version, so work them
+    # out up front for the versions people are likely to ask about
+    latest_versions = load_latest_versions(releases, 1)
+    latest_release = latest_versions[0] if latest_versions else None
+    readiness_by_python_version = {
+        str(python_version): get_readiness_statuses(TargetPython.from_version(python_version), latest_release, python_classifier_versions)
+        for python_version in PRECOMPUTED_PYTHON_VERSIONS
+    }
+    return dict(
+        python_classifier_versions=python_classifier_versions,
+        releases=releases,
+        readiness_by_python_version=readiness_by_python_version,
+    )
+
+
+@cache_json("top-wheels.json", max_age=PROJECT_META_MAX_AGE)
+def load_top_wheels():
+    # Only the parts of each project's metadata that readiness checks look at,
+    # with wheel filenames already parsed, so that later runs skip both the full
+    # metadata and parse_wheel_filename
+    names = fetch_top_metas()
+    # Parsing is CPU-bound, so spread the projects over processes
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        return dict(zip(names, executor.map(summarize_project, names)))
+
+
+def load_latest_versions(releases, count: int) -> t.List[PackageVersion]:
+    # Pick the latest releases by their version strings first, so that wheels only
+    # get built for the releases that are actually looked at
+    latest_version_strings = heapq.nlargest(count, releases, key=parse_version)
+    return [
+        PackageVersion(version=parse_version(version_string), wheels=[Wheel.from_dict(wheel) for wheel in releases[version_string]])
+        for version_string in latest_version_strings
+    ]
 
 
 def is_cpython_compatible(tag: str) -> bool:
     return tag.startswith("cp") or tag.startswith("py")
 
 
+@functools.lru_cache(maxsize=None)
 def parse_wheel_python_tag(tag: str) -> Version:
     version_part = tag[2:]
     major_version = version_part[0]
     minor_version = version_part[1:]
-    return Version(".".join((major_version, minor_version)) if minor_version else major_version)
+    return parse_version(".".join((major_version, minor_version)) if minor_version else major_version)
+
 
+@dataclasses.dataclass(frozen=True, slots=True)
+class TargetPython:
+    # The Python version being checked, along with everything the checks derive
+    # from it, worked out once per run instead of once per project
+    version: Version
+    major: int
+    minor: int
+    classifier_version: str
+    minor_classifier_prefix: str
+
+    @classmethod
+    def from_version(cls, version: Version) -> "TargetPython":
+        return cls(
+            version=version,
+            major=version.major,
+            minor=version.minor,
+            classifier_version=str(version),
+            minor_classifier_prefix=f"{version.major}.",
+        )
 
-def any_matches(version_constraints: t.Set[ComparableVersion], version: Version) -> bool:
-    for comparator, base_version in version_constraints:
-        match comparator:
-            case ">=":
-                if version >= base_version:
-                    return True
-            case "==":
-                if version == base_version:
-                    return True
-    return False
 
+def any_previous_minor_matches(abi3_floor: t.Optional[t.Tuple[int, int]], exact_versions: t.Set[t.Tuple[int, int]], target: TargetPython) -> bool:
+    # Equivalent to checking each of the target's previous minor versions in turn:
+    # if any of them is past the abi3 floor, the one right before the target is too.
+    if target.minor == 0:
+        return False
+    previous_minor_version = (target.major, target.minor - 1)
+    if abi3_floor is not None and previous_minor_version >= abi3_floor:
+        return True
+    return any(major == target.major and minor < target.minor for major, minor in exact_versions)
 
-def get_support_status_based_on_wheel_version(python_version: Version, package_versions: t.Sequence[PackageVersion]) -> ReadyStatus:
-    if not package_versions:
+
+def get_support_status_based_on_wheel_version(target: TargetPython, latest_version: t.Optional[PackageVersion]) -> ReadyStatus:
+    if latest_version is None:
         return ReadyStatus.unknown
 
-    latest_version = package_versions[-1]
-    python_version_constraints = set()
+    abi3_floors = []
+    exact_versions = set()
+    # A release's wheels for different platforms mostly repeat the same handful of
+    # tags, so only look at each distinct tag once
+    seen_tags = set()
     for wheel in latest_version.wheels:
-        # abi3 signals that the package adheres to a minimum set of instructions and
-        # is forward-compatible
-        comparator = ">=" if "abi3" in wheel.abi_tags else "=="
         for python_tag in wheel.python_tags:
+            if (python_tag, wheel.has_abi3) in seen_tags:
+                continue
+            seen_tags.add((python_tag, wheel.has_abi3))
             if not is_cpython_compatible(python_tag):
                 continue
             try:
                 for_python_version = parse_wheel_python_tag(python_tag)
-                python_version_constraints.add((comparator, for_python_version))
             except InvalidVersion:
                 print("warn: ignoring invalid python version tag", python_tag, "from wheel", wheel.name, file=sys.stderr)
-
-    if any_matches(python_version_constraints, python_version):
-        return ReadyStatus.yes
-
-    minor_version_constraints = [pair for pair in python_version_constraints if len(pair[1].release) > 1]
-    for previous_minor_version in range(python_version.minor - 1, -1, -1):
-        previous_python_version = Version(f"{python_version.major}.{previous_minor_version}")
-        if any_matches(minor_version_constraints, previous_python_version):
-            return ReadyStatus.no
-
-    if any(map(lambda x: x[1].major == python_version.major, python_version_constraints)):
+                continue
+            # No need to look at the rest of the wheels once one of them is a match
+            if wheel.has_abi3:
+                if target.version >= for_python_version:
+                    return ReadyStatus.yes
+                abi3_floors.append(for_python_version)
+            else:
+                if target.version == for_python_version:
+                    return ReadyStatus.yes
+                exact_versions.add(for_python_version)
+
+    # Compare plain (major, minor) tuples from here on, for the versions that have a minor part
+    minor_abi3_floor = min((v.release[:2] for v in abi3_floors if len(v.release) > 1), default=None)
+    minor_exact_versions = {v.release[:2] for v in exact_versions if len(v.release) > 1}
+    if any_previous_minor_matches(minor_abi3_floor, minor_exact_versions, target):
+        return ReadyStatus.no
+
+    if any(v.major == target.major for v in itertools.chain(abi3_floors, exact_versions)):
         return ReadyStatus.maybe
 
     return ReadyStatus.unknown
 
 
-def trove_classifier_string(python_version: str) -> str:
-    return f"Programming Language :: Python :: {python_version}"
+def list_python_classifier_versions(classifiers: t.Sequence[str]) -> t.List[str]:
+    # The Python versions in the classifiers, e.g. "3" and "3.11" (but not "3 :: Only"),
+    # in the order the project lists them
+    versions = []
+    for classifier in classifiers:
+        match = PYTHON_CLASSIFIER_RE.fullmatch(classifier)
+        if match:
+            versions.append(match.group(1))
+    return versions
 
 
-def get_support_status_based_on_classifier(python_version: Version, classifiers: t.Sequence[str]) -> ReadyStatus:
+def get_support_status_based_on_classifier(target: TargetPython, classifier_versions: t.FrozenSet[str]) -> ReadyStatus:
     # Is the exact version in the classifiers?
-    if trove_classifier_string(str(python_version)) in classifiers:
+    if target.classifier_version in classifier_versions:
         return ReadyStatus.yes
 
     # If this package lists Python versions at the granularity of minor versions,
     # and yet the exact version was not in its classifiers (see the conditional above),
     # it might mean this particular Python version is not supported.
-    minor_classifier = trove_classifier_string(f"{python_version.major}.")
-    for classifier in classifiers:
-        if classifier.startswith(minor_classifier):
-            return ReadyStatus.no
+    if any(version.startswith(target.minor_classifier_prefix) for version in classifier_versions):
+        return ReadyStatus.no
 
-    if trove_classifier_string("3") in classifiers:
+    if "3" in classifier_versions:
         return ReadyStatus.maybe
 
     return ReadyStatus.unknown
 
 
+def get_readiness_statuses(target: TargetPython, latest_release: t.Optional[PackageVersion], python_classifier_versions: t.Sequence[str]) -> t.Dict[str, str]:
+    version_status = get_support_status_based_on_wheel_version(target, latest_release)
+    classifier_status = get_support_status_based_on_classifier(target, frozenset(python_classifier_versions))
+    combined_status = min(version_status, classifier_status)
+    return dict(
+        version_readiness=version_status.name,
+        classifier_readiness=classifier_status.name,
+        combined_readiness=combined_status.name,
+    )
+
+
+def readiness_status_of_project(project_name: str, project: dict, target: TargetPython) -> dict:
+    # Only the latest two releases make it to the output, so there's no need to sort them all
+    latest_versions = load_latest_versions(project["releases"], 2)
+    latest_release = latest_versions[0] if latest_versions else None
+    previous_release = latest_versions[1] if len(latest_versions) > 1 else None
+    python_classifier_versions = project["python_classifier_versions"]
+
+    statuses = project["readiness_by_python_version"].get(target.classifier_version)
+    if statuses is None:
+        statuses = get_readiness_statuses(target, latest_release, python_classifier_versions)
+
+    classifier_versions = [version for version in python_classifier_versions if version.startswith("3")]
+
+    return dict(
+        project=project_name,
+        latest_version=str(latest_release.version) if latest_release else None,
+        latest_wheels=[wheel.to_dict() for wheel in latest_release.wheels] if latest_release else [],
+        previous_version=str(previous_release.version) if previous_release else None,
+        previous_wheels=[wheel.to_dict() for wheel in previous_release.wheels] if previous_release else [],
+        classifier_versions=classifier_versions,
+        **statuses,
+    )
+
+
 def readiness_statuses_of_top_projects(python_version: Version):
-    metas = load_top_metas()
-
-    output = []
-    for project_name, project_meta in metas.items():
-        versions = list(sorted(list_available_versions(project_meta)))
-        classifiers = project_meta["info"]["classifiers"]
-
-        version_status = get_support_status_based_on_wheel_version(python_version, versions)
-        classifier_status = get_support_status_based_on_classifier(python_version, classifiers)
-        combined_status = min(version_status, classifier_status)
-
-        latest_release = versions[-1] if versions else None
-        previous_release = versions[-2] if len(versions) > 1 else None
-        classifier_versions = [s.lstrip(trove_classifier_string("")) for s in classifiers if s.startswith(trove_classifier_string("3")) and not s.endswith(":: Only")]
-
-        project_data = dict(
-            project=project_name,
-            latest_version=str(latest_release.version) if latest_release else None,
-            latest_wheels=[dataclasses.asdict(wheel) for wheel in latest_release.wheels] if latest_release else [],
-            previous_version=str(previous_release.version) if previous_release else None,
-            previous_wheels=[dataclasses.asdict(wheel) for wheel in previous_release.wheels] if previous_release else [],
-            classifier_versions=classifier_versions,
-            version_readiness=version_status.name,
-            classifier_readiness=classifier_status.name,
-            combined_readiness=combined_status.name,
-        )
-        output.append(project_data)
+    target = TargetPython.from_version(python_version)
+    projects = load_top_wheels()
+    output = [readiness_status_of_project(project_name, project, target) for project_name, project in projects.items()]
 
-    print(json.dumps(output))
+    sys.stdout.buffer.write(orjson.dumps(output) + b"\n")
 
 
 if __name__ == "__main__":